@@ -1,9 +1,11 @@
 import bpy
+import traceback
 from time import time
 from os import path
 from mathutils import Matrix
 from . import sc_import
 from . import sc_export
+from . import sc_vfs
 
 bl_info = {
     'name': 'Supreme Commander SCM & SCA format',
@@ -18,6 +20,90 @@ bl_info = {
 }
 
 
+def sc_file_list(directory, files, archive_filter, ext):
+    # selected archives are expanded into the virtual paths of their members which match the filter
+    for filename in files:
+        filepath = path.join(directory, filename.name)
+        if not sc_vfs.is_archive(filepath):
+            yield directory, filename.name
+            continue
+        for member_path in sc_vfs.glob(filepath, archive_filter):
+            if member_path.lower().endswith(ext): yield path.split(member_path)
+
+
+class SCBatchOperator:
+    '''Mixin for operators whose work is split into batch_items, each processed by batch_step.
+    With use_modal the steps run under a timer within a frame time budget, reporting progress and stopping on Esc.
+    Items are kept across events, so they must refer to blender data by name rather than holding it, as an undo invalidates it.'''
+    frame_budget = 1 / 30
+    batch_empty_message = 'Nothing to process'
+
+    def batch_finish(self, context):
+        pass
+
+    def batch_item_name(self, item):
+        return item[0]
+
+    def batch_run_step(self, context, item):
+        # a malformed file is skipped rather than stopping the batch, which would also leave the modal timer behind
+        try: self.batch_step(context, item)
+        except Exception as e:
+            traceback.print_exc()
+            self.report({'WARNING'}, f'{self.bl_label} skipped {self.batch_item_name(item)}: {e}')
+
+    def execute(self, context):
+        self._items = list(self.batch_items(context))
+        if not self._items:
+            self.report({'WARNING'}, self.batch_empty_message)
+            return {'CANCELLED'}
+
+        # only a batch started from the ui runs modally, scripts expect the work to be done when the operator returns
+        if not self.use_modal or not self.options.is_invoke or bpy.app.background or context.window is None:
+            for item in self._items: self.batch_run_step(context, item)
+            sc_vfs.close_archives()
+            self.batch_finish(context)
+            return {'FINISHED'}
+
+        self._index = 0
+        wm = context.window_manager
+        wm.progress_begin(0, max(len(self._items), 1))
+        self._timer = wm.event_timer_add(0.001, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            # files which are already done are kept
+            print(self.bl_label, 'cancelled after', self._index, 'of', len(self._items))
+            return self.batch_end(context)
+
+        if event.type != 'TIMER': return {'PASS_THROUGH'}
+
+        t = time()
+        while self._index < len(self._items) and time() - t < self.frame_budget:
+            # the index is advanced first, so that a failing item is never stepped again
+            self._index += 1
+            self.batch_run_step(context, self._items[self._index - 1])
+
+        if self._index >= len(self._items): return self.batch_end(context)
+
+        context.window_manager.progress_update(self._index)
+        context.workspace.status_text_set(f'{self.bl_label}: {self._index} / {len(self._items)} (Esc to cancel)')
+        return {'RUNNING_MODAL'}
+
+    def batch_end(self, context):
+        self.cancel(context)
+        self.batch_finish(context)
+        return {'FINISHED'}
+
+    def cancel(self, context):
+        sc_vfs.close_archives()
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+
 class SCAnimationActionNew(bpy.types.Operator):
     bl_idname = 'sc.animation_action_new'
     bl_label = 'New Action'
@@ -49,22 +135,40 @@ class SCAnimationProps(bpy.types.PropertyGroup):
     action: bpy.props.PointerProperty(type=bpy.types.Action)
     frame_start: bpy.props.IntProperty(options=set(), name='Start Frame', default=0)
     frame_end: bpy.props.IntProperty(options=set(), name='End Frame', default=30)
+    filepath: bpy.props.StringProperty(options=set(), name='File', subtype='FILE_PATH', description='File the animation was imported from')
+    file_stamp: bpy.props.StringProperty(options={'HIDDEN'})
+    export_fingerprint: bpy.props.StringProperty(options={'HIDDEN'})
+    export_hash: bpy.props.StringProperty(options={'HIDDEN'})
 
 
-class SCAnimationImport(bpy.types.Operator):
+class SCAnimationImport(SCBatchOperator, bpy.types.Operator):
     bl_idname = 'sc.animations_import'
     bl_label = 'Import (.sca)'
     bl_description = 'Adds an animation management item and an associated action from reading the given file'
     bl_options = {'UNDO'}
 
-    filter_glob: bpy.props.StringProperty(options={'HIDDEN'}, default='*.sca')
+    filter_glob: bpy.props.StringProperty(options={'HIDDEN'}, default='*.sca;*.scd')
     directory: bpy.props.StringProperty()
     files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
-
-    def execute(self, context):
-        for filename in self.files:
-            sc_import.sca(context.object, self.directory, filename.name)
-        return {'FINISHED'}
+    archive_filter: bpy.props.StringProperty(options=set(), name='Archive Filter', description='Pattern of the files to import from selected .scd archives, for example units/uel0001/*.sca', default='*')
+    frame_start: bpy.props.IntProperty(options=set(), name='Start Frame', description='First frame of the file to import', default=0, min=0)
+    frame_end: bpy.props.IntProperty(options=set(), name='End Frame', description='Last frame of the file to import. -1 imports up to the end of the file', default=-1, min=-1)
+    frame_step: bpy.props.IntProperty(options=set(), name='Frame Step', description='Imports only every nth frame', default=1, min=1)
+    use_modal: bpy.props.BoolProperty(options=set(), name='Run in Background', description='Keeps Blender responsive while importing, showing progress and allowing Esc to cancel', default=True)
+    batch_empty_message = 'No files to import, check that the Archive Filter matches files in the selected archives'
+
+    def batch_items(self, context):
+        options = {'frame_start': self.frame_start, 'frame_end': self.frame_end, 'frame_step': self.frame_step}
+        for dirname, filename in sc_file_list(self.directory, self.files, self.archive_filter, '.sca'):
+            yield context.object.name, dirname, filename, options
+
+    def batch_item_name(self, item):
+        return path.join(item[1], item[2])
+
+    def batch_step(self, context, item):
+        ob_name, dirname, filename, options = item
+        ob = bpy.data.objects.get(ob_name)
+        if ob and not sc_import.sca(ob, dirname, filename, options): self.report({'WARNING'}, f'Nothing imported from {filename}, see the console')
 
     def invoke(self, context, event):
         context.window_manager.fileselect_add(self)
@@ -79,10 +183,23 @@ class SCAnimationExport(bpy.types.Operator):
 
     filter_glob: bpy.props.StringProperty(options={'HIDDEN'}, default='*.sca')
     directory: bpy.props.StringProperty(options={'HIDDEN'})
+    export_all: bpy.props.BoolProperty(options=set(), name='All Animations', description='Exports every animation in the list instead of only the selected one', default=False)
+    changed_only: bpy.props.BoolProperty(options=set(), name='Changed Only', description='Skips animations whose action, frame range and skeleton have not changed since they were last exported to this file', default=False)
 
     def execute(self, context):
         ob = context.object
-        sc_export.sca(self.directory, ob, ob.sc_animations[ob.sc_animations_index], ob.sc_animations_index)
+        # casting to int because sc_animations_index is a reference
+        sc_anim_index = int(ob.sc_animations_index)
+        options = {'changed_only': self.changed_only}
+
+        for ii in range(len(ob.sc_animations)) if self.export_all else (sc_anim_index,):
+            if ii < 0: continue
+            t = time()
+            anim = ob.sc_animations[ii]
+            if sc_export.sca(self.directory, ob, anim, ii, options): print('export time', self.directory, anim.name, time() - t)
+            else: print('export skipped', self.directory, anim.name)
+
+        ob.sc_animations_index = sc_anim_index
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -163,6 +280,35 @@ def sc_anim_update(self, context):
         context.scene.frame_end = anim.frame_end - 1
 
 
+watch_interval = 1.0
+
+
+def sc_anim_watch():
+    watching = False
+    for ob in bpy.data.objects:
+        if ob.type != 'ARMATURE' or not ob.sc_animations_watch: continue
+        watching = True
+        for anim in ob.sc_animations:
+            # an error must not escape the timer, as that would unregister it and stop watching
+            try:
+                if sc_import.sca_changed(anim) and sc_import.sca_reload(ob, anim): print('reloaded', ob.name, anim.name, anim.filepath)
+            except Exception as e: print('could not reload', ob.name, anim.name, anim.filepath, e)
+    sc_vfs.close_archives()
+    # the timer stops itself once no armature is being watched
+    return watch_interval if watching else None
+
+
+def sc_anim_watch_update(self, context):
+    if self.sc_animations_watch and not bpy.app.timers.is_registered(sc_anim_watch):
+        bpy.app.timers.register(sc_anim_watch, first_interval=watch_interval, persistent=True)
+
+
+@bpy.app.handlers.persistent
+def sc_anim_watch_load(*args):
+    if not bpy.app.timers.is_registered(sc_anim_watch):
+        bpy.app.timers.register(sc_anim_watch, first_interval=watch_interval, persistent=True)
+
+
 class SCAnimationPanel(bpy.types.Panel):
     bl_idname = 'OBJECT_PT_SC_ANIMATION'
     bl_label = 'Supreme Commander Animations'
@@ -182,6 +328,7 @@ class SCAnimationPanel(bpy.types.Panel):
         rows = 4 if len(ob.sc_animations) else 2
 
         layout.operator('sc.animations_import')
+        layout.prop(ob, 'sc_animations_watch')
         layout.separator()
         row = layout.row()
         col = row.column()
@@ -202,29 +349,51 @@ class SCAnimationPanel(bpy.types.Panel):
         row = layout.row()
         row.prop(anim, 'frame_start', text='Frame Range')
         row.prop(anim, 'frame_end', text='')
+        if anim.filepath: layout.prop(anim, 'filepath')
         layout.separator()
         layout.operator('sc.animation_export')
 
 
 class SCImportProps(bpy.types.PropertyGroup):
     generate_materials: bpy.props.BoolProperty(default=True, options=set(), name='Generate Blender Materials')
+    custom_normals: bpy.props.BoolProperty(default=True, options=set(), name='Custom Split Normals', description='Stores the normals from the file as custom split normals instead of adding an Edge Split modifier')
+    rigid_parts: bpy.props.BoolProperty(default=False, options=set(), name='Rigid Parts', description='Splits the mesh into one piece per bone, parented directly to that bone instead of deformed by an Armature modifier')
+    reuse_data: bpy.props.BoolProperty(default=True, options=set(), name='Reuse Imported Data', description='Links new objects to the mesh and armature data of files which were already imported and have not changed since')
+    import_lods: bpy.props.BoolProperty(default=False, options=set(), name='Import LOD Sets', description='Imports every _lodN.scm file of a unit onto a single shared armature')
 
 
-class SCImportOperator(bpy.types.Operator):
+class SCImportOperator(SCBatchOperator, bpy.types.Operator):
     bl_idname = 'sc.import'
     bl_label = 'Import (.scm)'
     bl_options = {'UNDO'}
 
-    filter_glob: bpy.props.StringProperty(options={'HIDDEN'}, default='*.scm')
+    filter_glob: bpy.props.StringProperty(options={'HIDDEN'}, default='*.scm;*.scd')
     directory: bpy.props.StringProperty()
     files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
-
-    def execute(self, context):
-        for filename in self.files:
-            t = time()
-            sc_import.scm(self.directory, filename.name, dict(context.scene.sc_import_props))
-            print('import time', self.directory, filename.name, time() - t)
-        return {'FINISHED'}
+    archive_filter: bpy.props.StringProperty(options=set(), name='Archive Filter', description='Pattern of the files to import from selected .scd archives, for example units/uel0001/*_lod0.scm', default='*')
+    use_modal: bpy.props.BoolProperty(options=set(), name='Run in Background', description='Keeps Blender responsive while importing, showing progress and allowing Esc to cancel', default=True)
+    batch_empty_message = 'No files to import, check that the Archive Filter matches files in the selected archives'
+
+    def batch_items(self, context):
+        options = dict(context.scene.sc_import_props)
+        unit_ids = set()
+        for dirname, filename in sc_file_list(self.directory, self.files, self.archive_filter, '.scm'):
+            unit_id = sc_import.scm_unit_id(filename) if options.get('import_lods', False) else None
+            if unit_id is None:
+                yield dirname, filename, None, options
+            elif (dirname, unit_id) not in unit_ids:
+                unit_ids.add((dirname, unit_id))
+                yield dirname, filename, unit_id, options
+
+    def batch_item_name(self, item):
+        return path.join(item[0], item[1])
+
+    def batch_step(self, context, item):
+        dirname, filename, unit_id, options = item
+        t = time()
+        if unit_id is None: sc_import.scm(dirname, filename, options)
+        else: sc_import.scm_unit(dirname, unit_id, options)
+        print('import time', dirname, filename, time() - t)
 
     def invoke(self, context, event):
         context.window_manager.fileselect_add(self)
@@ -232,16 +401,34 @@ class SCImportOperator(bpy.types.Operator):
 
     def draw(self, context):
         import_props = context.scene.sc_import_props
+        self.layout.prop(self, 'archive_filter')
+        self.layout.prop(self, 'use_modal')
         self.layout.prop(import_props, 'generate_materials')
+        self.layout.prop(import_props, 'custom_normals')
+        self.layout.prop(import_props, 'rigid_parts')
+        self.layout.prop(import_props, 'reuse_data')
+        self.layout.prop(import_props, 'import_lods')
+
+
+class SCExportProps(bpy.types.PropertyGroup):
+    incremental: bpy.props.BoolProperty(default=True, options=set(), name='Reuse Unchanged Meshes', description='Skips rebuilding the data of child meshes which have not changed since the last export')
+    dedup_tolerance: bpy.props.BoolProperty(default=False, options=set(), name='Merge Nearly Equal Vertices', description='Treats vertices whose position, normal and uv differ by less than the epsilons as the same vertex')
+    dedup_position_epsilon: bpy.props.FloatProperty(default=1e-4, min=1e-7, precision=7, options=set(), name='Position Epsilon')
+    dedup_normal_epsilon: bpy.props.FloatProperty(default=1e-3, min=1e-7, precision=7, options=set(), name='Normal Epsilon')
+    dedup_uv_epsilon: bpy.props.FloatProperty(default=1e-4, min=1e-7, precision=7, options=set(), name='UV Epsilon')
+    generate_lods: bpy.props.BoolProperty(default=False, options=set(), name='Generate LODs', description='Also exports decimated _lod1 to _lod3 files')
+    lod_ratios: bpy.props.FloatVectorProperty(default=(0.5, 0.25, 0.125), size=3, min=0.01, max=1.0, options=set(), name='LOD Ratios', description='Fraction of the faces of the exported mesh kept by LOD1, LOD2 and LOD3')
+    optimize_vertex_cache: bpy.props.BoolProperty(default=True, options=set(), name='Optimize Vertex Order', description='Reorders triangles and vertices for better GPU vertex cache reuse in game')
 
 
-class SCExportOperator(bpy.types.Operator):
+class SCExportOperator(SCBatchOperator, bpy.types.Operator):
     '''Saves an SCM file from an armature'''
     bl_idname = 'sc.export'
     bl_label = 'Export SCM'
 
     filter_glob: bpy.props.StringProperty(options={'HIDDEN'}, default='*.scm')
     directory: bpy.props.StringProperty(options={'HIDDEN'})
+    use_modal: bpy.props.BoolProperty(options=set(), name='Run in Background', description='Keeps Blender responsive while exporting, showing progress and allowing Esc to cancel', default=True)
 
     @classmethod
     def poll(cls, context):
@@ -251,19 +438,37 @@ class SCExportOperator(bpy.types.Operator):
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
 
-    def execute(self, context):
+    def batch_items(self, context):
+        options = dict(context.scene.sc_export_props)
         for ob in context.selected_objects:
-            if ob.type != 'ARMATURE': continue
-            t = time()
-            # store user setting. casting to int because sc_animations_index is a reference
-            sc_anim_index = int(ob.sc_animations_index)
-            # set anim index to none so that the pose is in default position
-            ob.sc_animations_index = -1
-            sc_export.scm(self.directory, ob)
-            # restore user setting
-            ob.sc_animations_index = sc_anim_index
-            print('export time', self.directory, ob.name, time() - t)
-        return {'FINISHED'}
+            if ob.type == 'ARMATURE': yield ob.name, options
+
+    def batch_step(self, context, item):
+        ob_name, options = item
+        ob = bpy.data.objects.get(ob_name)
+        if not ob: return
+        t = time()
+        # store user setting. casting to int because sc_animations_index is a reference
+        sc_anim_index = int(ob.sc_animations_index)
+        # set anim index to none so that the pose is in default position
+        ob.sc_animations_index = -1
+        sc_export.scm(self.directory, ob, options)
+        # restore user setting
+        ob.sc_animations_index = sc_anim_index
+        print('export time', self.directory, ob.name, time() - t)
+
+    def draw(self, context):
+        export_props = context.scene.sc_export_props
+        self.layout.prop(self, 'use_modal')
+        self.layout.prop(export_props, 'incremental')
+        self.layout.prop(export_props, 'optimize_vertex_cache')
+        self.layout.prop(export_props, 'dedup_tolerance')
+        if export_props.dedup_tolerance:
+            self.layout.prop(export_props, 'dedup_position_epsilon')
+            self.layout.prop(export_props, 'dedup_normal_epsilon')
+            self.layout.prop(export_props, 'dedup_uv_epsilon')
+        self.layout.prop(export_props, 'generate_lods')
+        if export_props.generate_lods: self.layout.prop(export_props, 'lod_ratios')
 
 
 def top_bar_import(self, context): self.layout.operator('sc.import', text='Supreme Commander Model (.scm)')
@@ -282,6 +487,7 @@ classes = (
     SCAnimationPanel,
     SCImportProps,
     SCImportOperator,
+    SCExportProps,
     SCExportOperator,
 )
 
@@ -289,14 +495,20 @@ classes = (
 def register():
     for clss in classes: bpy.utils.register_class(clss)
     bpy.types.Scene.sc_import_props = bpy.props.PointerProperty(type=SCImportProps)
+    bpy.types.Scene.sc_export_props = bpy.props.PointerProperty(type=SCExportProps)
     bpy.types.Object.sc_animations = bpy.props.CollectionProperty(type=SCAnimationProps)
     bpy.types.Object.sc_animations_index = bpy.props.IntProperty(default=-1, options=set(), update=sc_anim_update)
+    bpy.types.Object.sc_animations_watch = bpy.props.BoolProperty(default=False, options=set(), name='Reload Changed Files', description='Watches the files of the animations for changes and reloads their keyframes in place', update=sc_anim_watch_update)
+    bpy.app.handlers.load_post.append(sc_anim_watch_load)
     bpy.types.TOPBAR_MT_file_import.append(top_bar_import)
     bpy.types.TOPBAR_MT_file_export.append(top_bar_export)
 
 
 def unregister():
     for clss in reversed(classes): bpy.utils.unregister_class(clss)
+    bpy.app.handlers.load_post.remove(sc_anim_watch_load)
+    if bpy.app.timers.is_registered(sc_anim_watch): bpy.app.timers.unregister(sc_anim_watch)
+    sc_vfs.close_archives()
     bpy.types.TOPBAR_MT_file_import.remove(top_bar_import)
     bpy.types.TOPBAR_MT_file_export.remove(top_bar_export)
 
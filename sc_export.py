@@ -1,12 +1,20 @@
 import bpy
 import bmesh
 import math
+import struct
+from array import array
+from hashlib import blake2b
 from mathutils import Matrix, Vector, Quaternion
 from os import path
-from .sc_io import write_scm, write_sca
+from .sc_io import write_scm, write_sca, scm_vert_format
+from .sc_optimize import acmr, optimize_faces, reorder_verts
 
 
 co_correction_mat = Matrix(((1, 0, 0), ( 0, 0, 1), ( 0, -1, 0))).to_4x4()
+scm_vert_struct = struct.Struct(scm_vert_format)
+
+# maps (armature name, child name) to the fingerprint and packed scm data of the child's last export
+scm_child_cache = {}
 
 
 def pad(size):
@@ -14,16 +22,173 @@ def pad(size):
     return val + 16 if (val < 4) else val
 
 
-def scm_data(ob):
-    depsgraph = bpy.context.evaluated_depsgraph_get()
+def scm_child_matrix(ob, child):
+    # relative to the armature through any parent chain, including children parented to bones
+    return ob.matrix_world.inverted() @ child.matrix_world
+
+
+def scm_child_fingerprint(ob, child, depsgraph, model_bones, options):
+    child_eval = child.evaluated_get(depsgraph)
+    me = child_eval.to_mesh(preserve_all_data_layers=True, depsgraph=depsgraph)
+    me.calc_normals_split()
+
+    h = blake2b()
+    h.update(repr(sorted(options.items())).encode())
+    h.update('\0'.join(f'{bone.name}:{bone.parent.name if bone.parent else ""}' for bone in model_bones).encode())
+    h.update('\0'.join(group.name for group in child.vertex_groups).encode())
+    h.update(child.parent_bone.encode() if child.parent_type == 'BONE' else b'')
+    h.update(array('f', (v for row in scm_child_matrix(ob, child) for v in row)))
+
+    for collection, attr, typecode, size in (
+        (me.vertices, 'co', 'f', 3),
+        (me.loops, 'normal', 'f', 3),
+        (me.loops, 'vertex_index', 'i', 1),
+        (me.polygons, 'loop_total', 'i', 1),
+        *((uv_layer.data, 'uv', 'f', 2) for uv_layer in me.uv_layers[:2]),
+    ):
+        data = array(typecode, [0]) * (len(collection) * size)
+        collection.foreach_get(attr, data)
+        h.update(data)
+
+    weights = array('f')
+    for vert in me.vertices:
+        for group in vert.groups: weights.extend((vert.index, group.group, group.weight))
+    h.update(weights)
+
+    child_eval.to_mesh_clear()
+    return h.digest()
+
+
+def scm_child_data(ob, child, depsgraph, model_bones, bone_to_id, options):
+    vert_data = bytearray()
+    face_data = array('I')
+    vert_counter = 0
+
+    vert_id_to_index = {}
+
+    # split normals keep hard edges and custom normals, which the averaged vertex normals of the bmesh would lose
+    # all data layers are asked for, as the viewport evaluation drops vertex groups after modifiers like Edge Split
+    child_eval = child.evaluated_get(depsgraph)
+    me = child_eval.to_mesh(preserve_all_data_layers=True, depsgraph=depsgraph)
+    me.calc_normals_split()
+    loop_normals = array('f', [0]) * (len(me.loops) * 3)
+    me.loops.foreach_get('normal', loop_normals)
+    loop_starts = array('i', [0]) * len(me.polygons)
+    me.polygons.foreach_get('loop_start', loop_starts)
+
+    bm = bmesh.new(use_operators=True)
+    bm.from_mesh(me)
+    child_eval.to_mesh_clear()
+
+    # stored on loop layers so that the normals are carried over to the loops made by triangulation
+    layers_normal = [bm.loops.layers.float.new(f'SC Normal {axis}') for axis in 'XYZ']
+    bm.faces.index_update()
+    for face in bm.faces:
+        loop_start = loop_starts[face.index]
+        for ii, loop in enumerate(face.loops):
+            for axis, layer in enumerate(layers_normal): loop[layer] = loop_normals[(loop_start + ii) * 3 + axis]
+
+    child_matrix = co_correction_mat @ scm_child_matrix(ob, child)
+    normal_matrix = child_matrix.to_3x3().inverted_safe().transposed()
+    bmesh.ops.transform(bm, matrix=child_matrix, verts=bm.verts, use_shapekey=False)
+    bmesh.ops.triangulate(bm, faces=bm.faces)
+
+    layer_deform = bm.verts.layers.deform.verify()
+
+    try: layer_uv0 = bm.loops.layers.uv.values()[0]
+    except IndexError: layer_uv0 = bm.loops.layers.uv.new('SCM 0')
+
+    try: layer_uv1 = bm.loops.layers.uv.values()[1]
+    except IndexError: layer_uv1 = bm.loops.layers.uv.new('SCM 1')
+
+    # vertex group index does not necessarily match bone heirarchy, so we need to map it
+    group_ii_to_bone_ii = {}
+    for ii, group in enumerate(child.vertex_groups):
+        bone = model_bones.get(group.name)
+        if bone is not None:
+            group_ii_to_bone_ii[ii] = bone_to_id[bone]
+
+    # with a tolerance, vertex attributes are quantized so that values differing only by float noise share a vertex
+    dedup_tolerance = options.get('dedup_tolerance', False)
+    if dedup_tolerance:
+        co_scale = 1 / options.get('dedup_position_epsilon', 1e-4)
+        no_scale = 1 / options.get('dedup_normal_epsilon', 1e-3)
+        uv_scale = 1 / options.get('dedup_uv_epsilon', 1e-4)
+        exact_ids = set()
+
+    # vertices of meshes parented to a bone, like rigid parts, fall back to that bone
+    parent_bone = model_bones.get(child.parent_bone) if child.parent_type == 'BONE' else None
+    default_deformation = bone_to_id[parent_bone] if parent_bone else 0
+
+    face_to_tan_bi = {}
+    loop_to_id_index = {}
+    for vert in bm.verts:
+        # sort by weight and then pick the first one with a matching bone
+        deformation = default_deformation
+        deformation_pairs = sorted(vert[layer_deform].items(), key=lambda x: x[1])
+        for deform_pair in deformation_pairs:
+            if group_ii_to_bone_ii.get(deform_pair[0]):
+                deformation = group_ii_to_bone_ii[deform_pair[0]]
+                break
+
+        for loop in vert.link_loops:
+            normal = (normal_matrix @ Vector([loop[layer] for layer in layers_normal])).normalized()
+            id_tuple = (*vert.co, *normal, *loop[layer_uv0].uv, deformation)
+            if dedup_tolerance:
+                exact_ids.add(id_tuple)
+                id_tuple = (
+                    *(round(v * co_scale) for v in vert.co),
+                    *(round(v * no_scale) for v in normal),
+                    *(round(v * uv_scale) for v in loop[layer_uv0].uv),
+                    deformation,
+                )
+            id_index = vert_id_to_index.get(id_tuple)
+            if id_index is None:
+                try:
+                    t, b = face_to_tan_bi[loop.face.index]
+                except KeyError:
+                    c1, c2, c3 = (L.vert.co for L in loop.face.loops)
+                    u1, u2, u3 = (L[layer_uv0].uv[0] for L in loop.face.loops)
+                    v1, v2, v3 = (1 - L[layer_uv0].uv[1] for L in loop.face.loops)
+                    d = (v2 - v1) * (u3 - u1) - (u2 - u1) * (v3 - v1)
+                    try:
+                        t = (((v3 - v1) * (c2 - c1) - (v2 - v1) * (c3 - c1)) / d).normalized()
+                        b = (((u3 - u1) * (c2 - c1) - (u2 - u1) * (c3 - c1)) / -d).normalized()
+                    except ZeroDivisionError:
+                        t = Vector((0, 0, 0))
+                        b = Vector((0, 0, 0))
+                    face_to_tan_bi[loop.face.index] = (t, b)
+
+                id_index = vert_counter
+                vert_id_to_index[id_tuple] = vert_counter
+                vert_data += scm_vert_struct.pack(*vert.co, *normal, *t, *b, loop[layer_uv0].uv[0], 1 - loop[layer_uv0].uv[1], loop[layer_uv1].uv[0], 1 - loop[layer_uv1].uv[1], deformation, 0, 0, 0)
+                vert_counter += 1
+            loop_to_id_index[loop] = id_index
+
+    for face in bm.faces:
+        for loop in face.loops:
+            face_data.append(loop_to_id_index[loop])
+
+    bm.free()
 
+    if dedup_tolerance:
+        print('vertices', child.name, len(exact_ids), '->', vert_counter, f'({len(exact_ids) - vert_counter} merged)')
+
+    if options.get('optimize_vertex_cache', True):
+        acmr_before = acmr(face_data)
+        order, face_data = reorder_verts(optimize_faces(face_data, vert_counter), vert_counter)
+        vert_size = scm_vert_struct.size
+        vert_data = b''.join(vert_data[v * vert_size:(v + 1) * vert_size] for v in order)
+        print('acmr', child.name, round(acmr_before, 3), round(acmr(face_data), 3))
+
+    return bytes(vert_data), face_data
+
+
+def scm_skeleton_data(ob):
     model_bones = ob.data.bones
 
-    model_head_data = [b'MODL', 5]
     total_bone_data = []
     bone_name_data = []
-    total_vert_data = []
-    total_face_data = []
 
     bone_to_id = {bone:ii for ii, bone in enumerate(model_bones)}
 
@@ -39,93 +204,115 @@ def scm_data(ob):
         offset_val += len(b.name) + 1
         bone_name_data.append(bytearray(b.name.encode('ascii')))
 
-    offset_val += pad(offset_val)
-    model_head_data.append(offset_val)
-    model_head_data.append(len(model_bones))
-    offset_val += len(model_bones) * 108
-    offset_val += pad(offset_val)
-    model_head_data.append(offset_val)
+    # tag, version, bone offset, bone count, vertex offset, unknown, vertex count, face offset, face count, info offset, info count, total bone count
+    # offsets and counts of the streamed sections are filled in by write_scm
+    model_head_data = [b'MODL', 5, 0, len(model_bones), 0, 0, 0, 0, 0, 0, 0, len(model_bones)]
 
-    vert_id_to_index = {}
-    vert_counter = 0
+    return model_head_data, total_bone_data, bone_name_data
 
-    for child in [child for child in ob.children_recursive if child.type == 'MESH']:
-        bm = bmesh.new(use_operators=True)
-        bm.from_object(child, depsgraph)
-        bmesh.ops.transform(bm, matrix=co_correction_mat @ child.matrix_local, verts=bm.verts, use_shapekey=False)
-        bmesh.ops.triangulate(bm, faces=bm.faces)
-
-        layer_deform = bm.verts.layers.deform.verify()
-
-        try: layer_uv0 = bm.loops.layers.uv.values()[0]
-        except IndexError: layer_uv0 = bm.loops.layers.uv.new('SCM 0')
-
-        try: layer_uv1 = bm.loops.layers.uv.values()[1]
-        except IndexError: layer_uv1 = bm.loops.layers.uv.new('SCM 1')
-
-        # vertex group index does not necessarily match bone heirarchy, so we need to map it
-        group_ii_to_bone_ii = {}
-        for ii, group in enumerate(child.vertex_groups):
-            bone = model_bones.get(group.name)
-            if bone is not None:
-                group_ii_to_bone_ii[ii] = bone_to_id[bone]
-
-        face_to_tan_bi = {}
-        loop_to_id_index = {}
-        for vert in bm.verts:
-            # sort by weight and then pick the first one with a matching bone
-            deformation = 0
-            deformation_pairs = sorted(vert[layer_deform].items(), key=lambda x: x[1])
-            for deform_pair in deformation_pairs:
-                if group_ii_to_bone_ii.get(deform_pair[0]):
-                    deformation = group_ii_to_bone_ii[deform_pair[0]]
-                    break
-
-            for loop in vert.link_loops:
-                id_tuple = (*vert.co, *vert.normal, *loop[layer_uv0].uv, deformation)
-                id_index = vert_id_to_index.get(id_tuple)
-                if id_index is None:
-                    try:
-                        t, b = face_to_tan_bi[loop.face.index]
-                    except KeyError:
-                        c1, c2, c3 = (L.vert.co for L in loop.face.loops)
-                        u1, u2, u3 = (L[layer_uv0].uv[0] for L in loop.face.loops)
-                        v1, v2, v3 = (1 - L[layer_uv0].uv[1] for L in loop.face.loops)
-                        d = (v2 - v1) * (u3 - u1) - (u2 - u1) * (v3 - v1)
-                        try:
-                            t = (((v3 - v1) * (c2 - c1) - (v2 - v1) * (c3 - c1)) / d).normalized()
-                            b = (((u3 - u1) * (c2 - c1) - (u2 - u1) * (c3 - c1)) / -d).normalized()
-                        except ZeroDivisionError:
-                            t = Vector((0, 0, 0))
-                            b = Vector((0, 0, 0))
-                        face_to_tan_bi[loop.face.index] = (t, b)
-
-                    id_index = vert_counter
-                    vert_id_to_index[id_tuple] = vert_counter
-                    total_vert_data.extend((*vert.co, *vert.normal, *t, *b, loop[layer_uv0].uv[0], 1 - loop[layer_uv0].uv[1], loop[layer_uv1].uv[0], 1 - loop[layer_uv1].uv[1], deformation, 0, 0, 0))
-                    model_head_data[3] = max(model_head_data[3], deformation)
-                    vert_counter += 1
-                loop_to_id_index[loop] = id_index
-
-        for face in bm.faces:
-            for loop in face.loops:
-                total_face_data.append(loop_to_id_index[loop])
-
-    model_head_data.extend((0, vert_counter))
-
-    offset_val += vert_counter * 68
-    offset_val += pad(offset_val)
-    model_head_data.append(offset_val)
-    model_head_data.append(len(total_face_data))
 
-    # info offset, info length, total bones
-    model_head_data.extend((0, 0, len(model_bones)))
+def scm_data(ob, options, skeleton=None, lod=0):
+    # brings object matrices up to date with the rest pose, which bone parented children depend on
+    bpy.context.view_layer.update()
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    model_bones = ob.data.bones
+    bone_to_id = {bone:ii for ii, bone in enumerate(model_bones)}
+
+    # the skeleton section can be computed once and shared by every lod of the model
+    model_head_data, total_bone_data, bone_name_data = skeleton or scm_skeleton_data(ob)
+
+    return model_head_data, total_bone_data, bone_name_data, scm_meshes(ob, depsgraph, model_bones, bone_to_id, options, lod), b''
+
 
-    return model_head_data, total_bone_data, bone_name_data, total_vert_data, total_face_data, b''
+def scm_children(ob):
+    return [child for child in ob.children_recursive if child.type == 'MESH']
 
 
-def scm(dirname, ob):
-    write_scm(path.join(dirname, ob.name + '.scm'), *scm_data(ob))
+def scm_meshes(ob, depsgraph, model_bones, bone_to_id, options, lod=0):
+    for child in scm_children(ob):
+        cache_key = (ob.name, child.name, lod)
+        fingerprint = scm_child_fingerprint(ob, child, depsgraph, model_bones, options) if options.get('incremental', True) else None
+        try:
+            cached_fingerprint, child_data = scm_child_cache[cache_key]
+            if fingerprint is None or cached_fingerprint != fingerprint: raise KeyError
+        except KeyError:
+            child_data = scm_child_data(ob, child, depsgraph, model_bones, bone_to_id, options)
+            if fingerprint is not None: scm_child_cache[cache_key] = (fingerprint, child_data)
+
+        yield child_data
+
+
+def scm_lod_protected_verts(child):
+    # vertices on uv seams, mesh boundaries and between differently weighted bones must survive decimation
+    bm = bmesh.new()
+    bm.from_mesh(child.data)
+
+    layer_deform = bm.verts.layers.deform.active
+    layer_uv = bm.loops.layers.uv.active
+
+    def vert_bone(vert):
+        weights = vert[layer_deform].items() if layer_deform else ()
+        return max(weights, key=lambda x: x[1])[0] if weights else -1
+
+    protected = set()
+    for edge in bm.edges:
+        v1, v2 = edge.verts
+        boundary = edge.seam or edge.is_boundary or vert_bone(v1) != vert_bone(v2)
+
+        if not boundary and layer_uv and len(edge.link_loops) == 2:
+            # each face's loops along the edge give the uvs on that side of it
+            l1, l2 = edge.link_loops
+            uv1 = {L.vert: L[layer_uv].uv for L in (l1, l1.link_loop_next)}
+            uv2 = {L.vert: L[layer_uv].uv for L in (l2, l2.link_loop_next)}
+            boundary = any((uv1[v] - uv2[v]).length > 1e-5 for v in (v1, v2))
+
+        if boundary: protected.update((v1.index, v2.index))
+
+    bm.free()
+    return list(protected)
+
+
+def scm_lod_begin(children, ratio):
+    for child in children:
+        group = child.vertex_groups.new(name='SC LOD Protect')
+        group.add(scm_lod_protected_verts(child), 1.0, 'REPLACE')
+
+        modifier = child.modifiers.new('SC LOD', 'DECIMATE')
+        modifier.decimate_type = 'COLLAPSE'
+        modifier.ratio = ratio
+        modifier.use_collapse_triangulate = True
+        # inverted, so that the protected vertices have no weight and are not collapsed
+        modifier.vertex_group = group.name
+        modifier.invert_vertex_group = True
+
+    bpy.context.view_layer.update()
+
+
+def scm_lod_end(children):
+    for child in children:
+        modifier = child.modifiers.get('SC LOD')
+        if modifier: child.modifiers.remove(modifier)
+        group = child.vertex_groups.get('SC LOD Protect')
+        if group: child.vertex_groups.remove(group)
+
+    bpy.context.view_layer.update()
+
+
+def scm(dirname, ob, options):
+    skeleton = scm_skeleton_data(ob)
+    write_scm(path.join(dirname, ob.name + '.scm'), *scm_data(ob, options, skeleton))
+
+    if not options.get('generate_lods', False): return
+
+    base_name = ob.name[:-5] if ob.name.lower().endswith('_lod0') else ob.name
+    children = scm_children(ob)
+    for lod, ratio in enumerate(options.get('lod_ratios', (0.5, 0.25, 0.125)), 1):
+        # a failure part way through scm_lod_begin must still remove what it already added, which scm_lod_end tolerates
+        try:
+            scm_lod_begin(children, ratio)
+            write_scm(path.join(dirname, f'{base_name}_lod{lod}.scm'), *scm_data(ob, options, skeleton, lod))
+        finally: scm_lod_end(children)
 
 
 def sca_data(ob, sc_anim, sc_anim_index):
@@ -136,26 +323,20 @@ def sca_data(ob, sc_anim, sc_anim_index):
     anim_bones = ob.pose.bones
     bone_to_ii = {bone:ii for ii, bone in enumerate(anim_bones)}
 
-    anim_header_data = [b'ANIM', 5, len(frame_list), frame_list[-1] / 30, len(anim_bones)]
-    total_frame_data = []
+    # tag, version, frame count, duration, bone count, name offset, link offset, frame offset, frame size
+    # everything but the bone count is filled in by write_sca as the frames are streamed out
+    anim_header_data = [b'ANIM', 5, 0, 0.0, len(anim_bones), 0, 0, 0, 0]
     total_name_data = chr(0).join([bone.name for bone in anim_bones]) + chr(0)
     total_link_data = [bone_to_ii[bone.parent] if bone.parent else -1 for bone in anim_bones]
 
-    offset_val = 36  # header
-    offset_val += pad(offset_val)
-    anim_header_data.append(offset_val)
-    offset_val += len(total_name_data)  # names
-    offset_val += pad(offset_val)
-    anim_header_data.append(offset_val)
-    offset_val += len(anim_bones) * 4  # links
-    offset_val += pad(offset_val)
-    anim_header_data.append(offset_val)
-    anim_header_data.append(8 + 28 * len(anim_bones))  # frame_size
+    return anim_header_data, total_name_data, total_link_data, sca_frames(anim_bones, frame_list)
+
 
+def sca_frames(anim_bones, frame_list):
     for frame in frame_list:
         bpy.context.scene.frame_set(frame)
 
-        total_frame_data.extend((frame / 30, 0))
+        frame_data = [frame / 30, 0]
 
         for pb in anim_bones:
 
@@ -165,11 +346,54 @@ def sca_data(ob, sc_anim, sc_anim_index):
                 rel_mat = pb.matrix.transposed() @ pb.parent.matrix.transposed().inverted()
             rel_mat.transpose()
 
-            total_frame_data.extend(rel_mat.to_translation())
-            total_frame_data.extend(rel_mat.to_quaternion().normalized())
+            frame_data.extend(rel_mat.to_translation())
+            frame_data.extend(rel_mat.to_quaternion().normalized())
+
+        yield frame_data
+
+
+def sca_fingerprint(ob, sc_anim):
+    h = blake2b()
+    h.update(f'{sc_anim.frame_start}|{sc_anim.frame_end}'.encode())
+
+    for bone in ob.data.bones:
+        h.update(f'{bone.name}:{bone.parent.name if bone.parent else ""}'.encode())
+        h.update(array('f', (v for row in bone.matrix_local for v in row)))
+
+    if sc_anim.action:
+        for fcurve in sc_anim.action.fcurves:
+            h.update(f'{fcurve.data_path}[{fcurve.array_index}]'.encode())
+            keyframes = fcurve.keyframe_points
+            for attr in ('co', 'handle_left', 'handle_right'):
+                data = array('f', [0]) * (len(keyframes) * 2)
+                keyframes.foreach_get(attr, data)
+                h.update(data)
+            data = array('i', [0]) * len(keyframes)
+            keyframes.foreach_get('interpolation', data)
+            h.update(data)
+
+    return h.hexdigest()
+
+
+def file_hash(filepath):
+    if not path.isfile(filepath): return ''
+    h = blake2b()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''): h.update(chunk)
+    return h.hexdigest()
+
+
+def sca(dirname, ob, sc_anim, sc_anim_index, options=None):
+    options = options or {}
+    filepath = path.join(dirname, sc_anim.name) + '.sca'
 
-    return anim_header_data, total_name_data, total_link_data, total_frame_data
+    # an animation is clean when neither its keyframes, frame range and skeleton nor the file written last time have changed
+    fingerprint = sca_fingerprint(ob, sc_anim)
+    if options.get('changed_only', False) and fingerprint == sc_anim.export_fingerprint and file_hash(filepath) == sc_anim.export_hash:
+        return False
 
+    write_sca(filepath, *sca_data(ob, sc_anim, sc_anim_index))
 
-def sca(dirname, ob, sc_anim, sc_anim_index):
-    write_sca(path.join(dirname, sc_anim.name) + '.sca', *sca_data(ob, sc_anim, sc_anim_index))
+    sc_anim.export_fingerprint = fingerprint
+    sc_anim.export_hash = file_hash(filepath)
+    return True
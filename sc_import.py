@@ -1,24 +1,146 @@
 import bpy
 import bmesh
+import struct
 from mathutils import Matrix, Vector, Quaternion
 from os import path
+from difflib import get_close_matches
 from .sc_mat import generate_bl_material
 from .sc_io import read_scm, read_sca, read_bp
+from . import sc_vfs
 
 
 co_correction_mat = Matrix(((1, 0, 0), ( 0, 0, 1), ( 0, -1, 0))).to_4x4()
 
+# maps an armature data name to its skeleton fingerprint and animation binding
+sca_binding_cache = {}
 
-def sca(ob, dirname, filename):
-    sca = read_sca(path.join(dirname, filename))
-    if not sca: return
+# maps an scm cache key to the names of the armature and mesh datablocks built from that file
+scm_cache = {}
+
+
+def sca_bone_key(name):
+    return ''.join(c for c in name.lower() if c.isalnum())
+
+
+def sca_binding(arm):
+    # the binding holds the rest transforms of every bone and the sca name to bone name mapping of each set of sca names,
+    # so that importing many files onto one armature only does the skeleton work once
+    fingerprint = tuple((bone.name, bone.parent.name if bone.parent else '', *(v for row in bone.matrix_local for v in row)) for bone in arm.bones)
+    cached = sca_binding_cache.get(arm.name)
+    if cached and cached[0] == fingerprint: return cached[1]
+
+    binding = {'rest': {}, 'keys': {}, 'files': {}}
+
+    for bone in arm.bones:
+        if not bone.parent:
+            bone_loc_vec = bone.head_local @ bone.matrix_local
+        else:
+            bone_loc_vec = (bone.head_local - bone.parent.head_local) @ (bone.matrix_local @ bone.parent.matrix_local @ co_correction_mat)
+
+        binding['rest'][bone.name] = (not bone.parent, bone.matrix.to_4x4(), bone_loc_vec)
+        binding['keys'].setdefault(sca_bone_key(bone.name), bone.name)
+
+    sca_binding_cache[arm.name] = (fingerprint, binding)
+    return binding
+
+
+def sca_fuzzy_allowed(key, match_key):
+    # numbered sibling bones like barrel02 and barrel03 are similar but never the same bone
+    return key.rstrip('0123456789') != match_key.rstrip('0123456789')
+
+
+def sca_binding_bones(binding, sc_links):
+    '''Returns the bone name of each sca link which could be bound, the links with no matching bone,
+    and the links whose matching bone was already bound to another link of the file'''
+    file_key = tuple(sc_links)
+    try: return binding['files'][file_key]
+    except KeyError: pass
+
+    link_bones = {}
+    bound = set()
+    misses = []
+    duplicates = []
+
+    def bind(sc_link, bone_name):
+        if bone_name in bound: duplicates.append(sc_link)
+        else:
+            link_bones[sc_link] = bone_name
+            bound.add(bone_name)
+
+    # every exact match of the file is bound before any normalized one, so that looser matches cannot take an exact match's bone
+    for sc_link in sc_links:
+        if sc_link in binding['rest']: bind(sc_link, sc_link)
+
+    leftovers = []
+    for sc_link in sc_links:
+        if sc_link in binding['rest']: continue
+        bone_name = binding['keys'].get(sca_bone_key(sc_link))
+        if bone_name is None: leftovers.append(sc_link)
+        else: bind(sc_link, bone_name)
+
+    # sometimes bone names differ slightly between the scm and sca, so what is left is fuzzy matched against the bones still free
+    for sc_link in leftovers:
+        key = sca_bone_key(sc_link)
+        free_keys = [bone_key for bone_key, bone_name in binding['keys'].items() if bone_name not in bound]
+        matches = [match for match in get_close_matches(key, free_keys, n=3, cutoff=0.8) if sca_fuzzy_allowed(key, match)]
+        if matches: bind(sc_link, binding['keys'][matches[0]])
+        else: misses.append(sc_link)
+
+    binding['files'][file_key] = (link_bones, misses, duplicates)
+    return binding['files'][file_key]
 
-    sc_links, sc_frames = sca
+
+def sca_file_stamp(filepath):
+    st = sc_vfs.stat(filepath)
+    return f'{st.st_mtime_ns}|{st.st_size}'
+
+
+def sca(ob, dirname, filename, options=None):
+    options = options or {}
+    filepath = path.join(dirname, filename)
+    sca = read_sca(filepath, options.get('frame_start', 0), options.get('frame_end', -1), options.get('frame_step', 1))
+    if not sca: return
+    if not sca[1]:
+        print('no frames of', filepath, 'in the frame window', options.get('frame_start', 0), options.get('frame_end', -1))
+        return
 
     anim = ob.sc_animations.add()
     anim.name = filename.rsplit('.')[0]
     anim.action = bpy.data.actions.new(anim.name)
+    anim.filepath = filepath
+    anim.file_stamp = sca_file_stamp(filepath)
+
+    sca_action(ob, anim, *sca)
+    return anim
+
+
+def sca_changed(anim):
+    if not anim.filepath or not sc_vfs.isfile(anim.filepath): return False
+    return sca_file_stamp(anim.filepath) != anim.file_stamp
+
+
+def sca_reload(ob, anim):
+    # re-reads the file and replaces the keyframes of the existing action rather than adding a new animation
+    # the stamp is taken before reading, and only stored once the read succeeded, so a file caught mid-write is retried on the next poll
+    file_stamp = sca_file_stamp(anim.filepath)
+    try: sca = read_sca(anim.filepath)
+    except (OSError, ValueError, struct.error) as e:
+        print('could not reload', anim.filepath, e)
+        return False
+    if not sca or not sca[1]: return False
+
+    anim.file_stamp = file_stamp
+
+    if anim.action:
+        for fcurve in list(anim.action.fcurves): anim.action.fcurves.remove(fcurve)
+    else:
+        anim.action = bpy.data.actions.new(anim.name)
+
+    sca_action(ob, anim, *sca)
+    return True
 
+
+def sca_action(ob, anim, sc_links, sc_frames):
     bones_frames = {sc_link:[] for sc_link in sc_links}
 
     anim.frame_start = 2147483647
@@ -32,11 +154,17 @@ def sca(ob, dirname, filename):
         for sc_link in sc_links:
             bones_frames[sc_link].append((*sc_frame[2][sc_link], bl_time, sc_frame[1]))
 
-    for bone_name, bone_frames in bones_frames.items():
+    binding = sca_binding(ob.data)
+    link_bones, misses, duplicates = sca_binding_bones(binding, sc_links)
+    if misses: print('no bone found in', ob.name, 'for', anim.name, misses)
+    if duplicates: print('bone already bound in', ob.name, 'for', anim.name, duplicates)
+
+    for sc_link, bone_frames in bones_frames.items():
+
+        bone_name = link_bones.get(sc_link)
+        if not bone_name: continue
 
-        # TODO find closest match as sometimes bone names differ slightly from scm and sca
-        bone = ob.data.bones.get(bone_name)
-        if not bone: continue  # TODO warning when bone match cannot be found
+        bone_is_root, bone_mat, bone_loc_vec = binding['rest'][bone_name]
 
         loc_path = 'pose.bones["{}"].location'.format(bone_name)
         rot_path = 'pose.bones["{}"].rotation_quaternion'.format(bone_name)
@@ -49,11 +177,6 @@ def sca(ob, dirname, filename):
         rotz = anim.action.fcurves.new(rot_path, index=2, action_group=bone_name)
         rotw = anim.action.fcurves.new(rot_path, index=3, action_group=bone_name)
 
-        if not bone.parent:
-            bone_loc_vec = bone.head_local @ bone.matrix_local
-        else:
-            bone_loc_vec = (bone.head_local - bone.parent.head_local) @ (bone.matrix_local @ bone.parent.matrix_local @ co_correction_mat)
-
         len_frames = len(bone_frames)
         key_sel = [False] * len_frames
         key_interp = [1] * len_frames
@@ -67,16 +190,14 @@ def sca(ob, dirname, filename):
 
         for bone_frame in bone_frames:
 
-            if not bone: continue
-
             sca_mat = Quaternion(bone_frame[3:7]).to_matrix().to_4x4()
             sca_mat.translation = Vector(bone_frame[0:3])
             sca_mat.transpose()
             
-            if not bone.parent:
+            if bone_is_root:
                 sca_mat @= co_correction_mat
             
-            pose_mat = (sca_mat @ bone.matrix.to_4x4()).transposed()
+            pose_mat = (sca_mat @ bone_mat).transposed()
             loc, rot = pose_mat.to_translation() - bone_loc_vec, pose_mat.to_quaternion()
 
             key_co_locx.extend((bone_frame[7], loc[0]))
@@ -99,11 +220,36 @@ def sca(ob, dirname, filename):
             fcurve.keyframe_points.foreach_set('select_right_handle', key_sel)
 
 
-def scm_armature(sc_bones, sc_bone_names, sc_id, options):
-    arm = bpy.data.armatures.new(sc_id)
+def scm_cache_key(filepath, options):
+    st = sc_vfs.stat(filepath)
+    mesh_options = (options.get('generate_materials', True), options.get('custom_normals', True), options.get('rigid_parts', False))
+    return f'{path.normcase(path.abspath(filepath))}|{st.st_mtime_ns}|{st.st_size}|{mesh_options}'
+
+
+def scm_cache_get(key, collection):
+    if key is None: return
+    data = collection.get(scm_cache.get(key, {}).get(collection.rna_type.identifier, ''))
+    # the name may have been reused by other data since it was cached, so the key stored on the data itself is checked
+    if data and data.get('sc_import_key') == key: return data
+
+
+def scm_cache_set(key, data):
+    if key is None: return
+    data['sc_import_key'] = key
+    scm_cache.setdefault(key, {})[data.rna_type.identifier] = data.name
+
+
+def scm_armature_object(arm, sc_id):
     ob = bpy.data.objects.new(sc_id, arm)
     bpy.context.collection.objects.link(ob)
     bpy.context.view_layer.objects.active = ob
+    ob.select_set(True)
+    return ob
+
+
+def scm_armature(sc_bones, sc_bone_names, sc_id, options):
+    arm = bpy.data.armatures.new(sc_id)
+    ob = scm_armature_object(arm, sc_id)
     bpy.ops.object.mode_set(mode='EDIT', toggle=False)
 
     for sc_bone, sc_bone_name in zip(sc_bones, sc_bone_names):
@@ -124,7 +270,6 @@ def scm_armature(sc_bones, sc_bone_names, sc_id, options):
 
     bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
 
-    ob.select_set(True)
     arm.show_axes = True
 
     return ob
@@ -162,6 +307,8 @@ def scm_mesh(scm, me, options):
 
     uvl0 = bm.loops.layers.uv.new('SCM 0')
     uvl1 = bm.loops.layers.uv.new('SCM 1')
+    # remembers which scm vertex each loop came from, as welding below changes the vertex indices
+    sc_vert_layer = bm.loops.layers.int.new('SC Vertex')
     for face in bm.faces:
         face.smooth = True
         face.select = False
@@ -169,6 +316,7 @@ def scm_mesh(scm, me, options):
             sc_vert = sc_vertices[loop.vert.index]
             loop[uvl0].uv = (sc_vert[12], -sc_vert[13] + 1)
             loop[uvl1].uv = (sc_vert[14], -sc_vert[15] + 1)
+            loop[sc_vert_layer] = loop.vert.index
 
     doubles = bmesh.ops.find_doubles(bm, verts=bm.verts, dist=0.00001)['targetmap']
     for origin in list(doubles.keys()):
@@ -188,45 +336,231 @@ def scm_mesh(scm, me, options):
     bm.to_mesh(me)
     bm.free()
 
+    # rigid parts are split off first, as custom normals would not survive the split
+    if not options.get('rigid_parts', False): scm_mesh_normals(me, sc_vertices, options)
 
-def scm_mesh_object(scm, arm_ob, dirname, filename, options, bp=None, lod=0):
-    sc_bones, sc_bone_names, sc_vertices, sc_faces = scm
 
-    me = bpy.data.meshes.new(filename)
+def scm_mesh_normals(me, sc_vertices, options):
+    sc_vert_attr = me.attributes['SC Vertex']
+    if options.get('custom_normals', True):
+        # the normals stored in the scm are written as custom split normals, so no edge split modifier is needed
+        sc_loop_verts = [0] * len(me.loops)
+        sc_vert_attr.data.foreach_get('value', sc_loop_verts)
+        me.use_auto_smooth = True
+        me.normals_split_custom_set([(sc_vertices[ii][3], -sc_vertices[ii][5], sc_vertices[ii][4]) for ii in sc_loop_verts])
+    me.attributes.remove(sc_vert_attr)
+
+
+def scm_mesh_object(scm, arm_ob, dirname, filename, options, bp=None, lod=0, me=None):
+    # when existing mesh data is given, only a new object is made for it
+    build = me is None
+    if build: me = bpy.data.meshes.new(filename)
+
     ob = bpy.data.objects.new(filename, me)
     ob.parent = arm_ob
     bpy.context.collection.objects.link(ob)
 
-    for ii, sc_bone in enumerate(sc_bones):
-        if lod > 0: ob.vertex_groups.new(name=sc_bone_names[ii])
-        else: ob.vertex_groups.new(name=sc_bone_names[ii])
-
     if lod > 0: ob.display_type = 'WIRE'
 
-    scm_mesh(scm, me, options)
+    if build:
+        sc_bones, sc_bone_names, sc_vertices, sc_faces = scm
+        for sc_bone_name in sc_bone_names: ob.vertex_groups.new(name=sc_bone_name)
+        scm_mesh(scm, me, options)
 
     modifier = ob.modifiers.new('Armature', 'ARMATURE')
     modifier.object = arm_ob
 
-    modifier = ob.modifiers.new('EdgeSplit', 'EDGE_SPLIT')
-    modifier.use_edge_angle = False
+    if not options.get('custom_normals', True):
+        modifier = ob.modifiers.new('EdgeSplit', 'EDGE_SPLIT')
+        modifier.use_edge_angle = False
 
-    if options.get('generate_materials', True) and bp:
+    if build and options.get('generate_materials', True) and bp:
         generate_bl_material(dirname, filename, me, bp, lod)
 
     return ob
 
 
+def scm_rigid_parts(ob, arm_ob, sc_vertices, options):
+    # every scm vertex is bound to exactly one bone, so the mesh can be split into pieces parented directly to their bones,
+    # which animate by object transform alone rather than being deformed per vertex
+    me = ob.data
+    bm = bmesh.new()
+    bm.from_mesh(me)
+    bm.faces.index_update()
+
+    layer_deform = bm.verts.layers.deform.active
+    group_faces = {}
+    skinned_faces = set()
+    for face in bm.faces:
+        groups = set()
+        for vert in face.verts:
+            weights = vert[layer_deform].items()
+            groups.add(max(weights, key=lambda x: x[1])[0] if weights else 0)
+        # a face spanning several bones stretches when they move apart, which a rigid piece can not do
+        if len(groups) > 1: skinned_faces.add(face.index)
+        else: group_faces.setdefault(groups.pop(), set()).add(face.index)
+
+    pieces = []
+    for group_index, faces in group_faces.items():
+        bone_name = ob.vertex_groups[group_index].name
+        bone = arm_ob.data.bones[bone_name]
+
+        piece_bm = bm.copy()
+        piece_bm.faces.index_update()
+        bmesh.ops.delete(piece_bm, geom=[face for face in piece_bm.faces if face.index not in faces], context='FACES')
+        piece_bm.verts.layers.deform.remove(piece_bm.verts.layers.deform.active)
+
+        piece_me = bpy.data.meshes.new(f'{ob.name}_{bone_name}')
+        piece_bm.to_mesh(piece_me)
+        piece_bm.free()
+
+        for material in me.materials: piece_me.materials.append(material)
+        scm_mesh_normals(piece_me, sc_vertices, options)
+
+        piece_ob = bpy.data.objects.new(piece_me.name, piece_me)
+        bpy.context.collection.objects.link(piece_ob)
+        piece_ob.display_type = ob.display_type
+
+        # the single vertex group lets the exporter assign the piece's vertices back to the bone
+        piece_ob.vertex_groups.clear()
+        piece_ob.vertex_groups.new(name=bone_name).add(range(len(piece_me.vertices)), 1.0, 'REPLACE')
+
+        piece_ob.parent = arm_ob
+        piece_ob.parent_type = 'BONE'
+        piece_ob.parent_bone = bone_name
+        # vertices stay in armature space, so the bone's rest transform is cancelled out
+        piece_ob.matrix_parent_inverse = (bone.matrix_local @ Matrix.Translation((0, bone.length, 0))).inverted()
+
+        if not options.get('custom_normals', True):
+            modifier = piece_ob.modifiers.new('EdgeSplit', 'EDGE_SPLIT')
+            modifier.use_edge_angle = False
+
+        pieces.append(piece_ob)
+
+    if not skinned_faces:
+        bm.free()
+        bpy.data.objects.remove(ob)
+        bpy.data.meshes.remove(me)
+        return pieces
+
+    # faces spanning several bones are kept on the original object, which is still deformed by its Armature modifier
+    print(len(skinned_faces), 'faces of', ob.name, 'span several bones and were kept skinned')
+    bmesh.ops.delete(bm, geom=[face for face in bm.faces if face.index not in skinned_faces], context='FACES')
+    bm.to_mesh(me)
+    bm.free()
+    scm_mesh_normals(me, sc_vertices, options)
+
+    return [*pieces, ob]
+
+
 def scm(dirname, filename, options):
     sc_id = filename.rsplit('.')[0]
-    scm = read_scm(path.join(dirname, filename))
-    sc_bones, sc_bone_names, sc_vertices, sc_faces = scm
-
-    bp_path = path.join(dirname, '_'.join(sc_id.split('_')[:-1]) + '_unit.bp')
-    bp = read_bp(bp_path) if path.isfile(bp_path) else None
+    filepath = path.join(dirname, filename)
 
     try: lod = int(sc_id.rsplit('_lod')[1][0])
     except (ValueError, IndexError) as e: lod = 0
 
+    key = scm_cache_key(filepath, options) if options.get('reuse_data', True) else None
+    arm = scm_cache_get(key, bpy.data.armatures)
+    me = scm_cache_get(key, bpy.data.meshes)
+    if arm and me:
+        arm_ob = scm_armature_object(arm, sc_id)
+        ob = scm_mesh_object(None, arm_ob, dirname, sc_id, options, lod=lod, me=me)
+        return
+
+    scm = read_scm(filepath)
+    sc_bones, sc_bone_names, sc_vertices, sc_faces = scm
+
+    bp_path = path.join(dirname, '_'.join(sc_id.split('_')[:-1]) + '_unit.bp')
+    bp = read_bp(bp_path) if sc_vfs.isfile(bp_path) else None
+
     arm_ob = scm_armature(sc_bones, sc_bone_names, sc_id, options)
     ob = scm_mesh_object(scm, arm_ob, dirname, sc_id, options, bp, lod=lod)
+
+    scm_cache_set(key, arm_ob.data)
+    # rigid pieces are not cached, so they are rebuilt from the file every time
+    if options.get('rigid_parts', False): scm_rigid_parts(ob, arm_ob, sc_vertices, options)
+    else: scm_cache_set(key, ob.data)
+
+
+def scm_unit_id(filename):
+    sc_id = filename.rsplit('.')[0]
+    unit_id, sep, lod = sc_id.rpartition('_lod')
+    return unit_id if sep and lod.isdigit() else None
+
+
+def scm_lod_files(dirname, unit_id):
+    lod_files = {}
+    for filename in sc_vfs.listdir(dirname):
+        if not filename.lower().endswith('.scm'): continue
+        sc_id = filename.rsplit('.')[0]
+        head, sep, lod = sc_id.rpartition('_lod')
+        if sep and lod.isdigit() and head.lower() == unit_id.lower():
+            lod_files[int(lod)] = filename
+    return [(lod, lod_files[lod]) for lod in sorted(lod_files)]
+
+
+def scm_lod_visibility(ob, bp, lod):
+    try: lods = bp['Display']['Mesh']['LODs']
+    except (KeyError, TypeError): lods = []
+
+    near = lods[lod - 1].get('LODCutoff', 0.0) if 0 < lod <= len(lods) else 0.0
+    far = lods[lod].get('LODCutoff', 2**31) if lod < len(lods) else 2**31
+    ob['sc_lod_cutoff'] = (near, far)
+
+    camera = bpy.context.scene.camera
+    if not camera:
+        ob.hide_render = lod > 0
+        ob.hide_set(lod > 0)
+        return
+
+    for prop in ('hide_viewport', 'hide_render'):
+        driver = ob.driver_add(prop).driver
+        driver.type = 'SCRIPTED'
+        var = driver.variables.new()
+        var.name = 'dist'
+        var.type = 'LOC_DIFF'
+        var.targets[0].id = ob.parent
+        var.targets[1].id = camera
+        driver.expression = f'dist < {near} or dist >= {far}'
+
+
+def scm_unit(dirname, unit_id, options):
+    lod_files = scm_lod_files(dirname, unit_id)
+    if not lod_files: return
+
+    bp_path = path.join(dirname, unit_id + '_unit.bp')
+    bp = read_bp(bp_path) if sc_vfs.isfile(bp_path) else None
+
+    arm_ob = None
+    for lod, filename in lod_files:
+        filepath = path.join(dirname, filename)
+        key = scm_cache_key(filepath, options) if options.get('reuse_data', True) else None
+
+        if arm_ob is None:
+            arm = scm_cache_get(key, bpy.data.armatures)
+            if arm: arm_ob = scm_armature_object(arm, unit_id)
+
+        me = scm_cache_get(key, bpy.data.meshes)
+        # the file is still needed on a mesh cache hit when there is no armature to put the mesh on yet
+        if me and arm_ob is not None:
+            scm = None
+        else:
+            scm = read_scm(filepath)
+            if not scm: continue
+
+        # all lods share the skeleton of the first one read, so the armature is only built once
+        if arm_ob is None:
+            arm_ob = scm_armature(scm[0], scm[1], unit_id, options)
+            scm_cache_set(key, arm_ob.data)
+
+        ob = scm_mesh_object(scm, arm_ob, dirname, filename.rsplit('.')[0], options, bp, lod=lod, me=me)
+
+        if options.get('rigid_parts', False): obs = scm_rigid_parts(ob, arm_ob, scm[2], options)
+        else:
+            obs = [ob]
+            scm_cache_set(key, ob.data)
+
+        for ob in obs: scm_lod_visibility(ob, bp, lod)
+
+    return arm_ob
@@ -0,0 +1,134 @@
+import sqlite3
+from hashlib import sha1
+from os import path, walk
+from .sc_io import read_scm_header, read_sca_header, read_bp
+
+# scm description
+#    path mtime vert_count face_count bone_count bone_names skeleton
+# sca description
+#    path mtime frame_count duration bone_count bone_names skeleton
+# bp description
+#    path mtime mesh_names texture_names
+# bone_names, mesh_names and texture_names are stored as newline separated text
+# skeleton is a fingerprint of the bone name set, so that files sharing a skeleton share a value regardless of bone order
+
+schema = '''
+CREATE TABLE IF NOT EXISTS scm (path TEXT PRIMARY KEY, mtime REAL, vert_count INTEGER, face_count INTEGER, bone_count INTEGER, bone_names TEXT, skeleton TEXT);
+CREATE TABLE IF NOT EXISTS sca (path TEXT PRIMARY KEY, mtime REAL, frame_count INTEGER, duration REAL, bone_count INTEGER, bone_names TEXT, skeleton TEXT);
+CREATE TABLE IF NOT EXISTS bp (path TEXT PRIMARY KEY, mtime REAL, mesh_names TEXT, texture_names TEXT);
+CREATE INDEX IF NOT EXISTS scm_skeleton ON scm (skeleton);
+CREATE INDEX IF NOT EXISTS sca_skeleton ON sca (skeleton);
+'''
+
+bp_texture_keys = ('AlbedoName', 'SpecTeamName', 'NormalsName', 'LookupName', 'SecondaryName')
+
+
+def skeleton_fingerprint(bone_names):
+    return sha1('\n'.join(sorted(name.lower() for name in bone_names)).encode()).hexdigest()
+
+
+def connect(db_path):
+    db = sqlite3.connect(db_path)
+    db.executescript(schema)
+    return db
+
+
+def index_scm(filepath):
+    scm = read_scm_header(filepath)
+    if not scm: return
+    modl, bone_names = scm
+    return modl[6], modl[8] // 3, len(bone_names), '\n'.join(bone_names), skeleton_fingerprint(bone_names)
+
+
+def index_sca(filepath):
+    sca = read_sca_header(filepath)
+    if not sca: return
+    anim, bone_names = sca
+    return anim[2], anim[3], len(bone_names), '\n'.join(bone_names), skeleton_fingerprint(bone_names)
+
+
+def index_bp(filepath):
+    bp = read_bp(filepath)
+    if bp is None: return
+
+    try: lods = bp['Display']['Mesh']['LODs']
+    except (KeyError, TypeError): lods = []
+
+    mesh_names = [lod['MeshName'] for lod in lods if lod.get('MeshName')]
+    texture_names = [lod[key] for lod in lods for key in bp_texture_keys if lod.get(key)]
+    return '\n'.join(mesh_names), '\n'.join(texture_names)
+
+
+def index_file_type(filename):
+    lower = filename.lower()
+    if lower.endswith('.scm'): return 'scm', index_scm
+    if lower.endswith('.sca'): return 'sca', index_sca
+    if lower.endswith('_unit.bp'): return 'bp', index_bp
+    return None, None
+
+
+def index_directory(db, root):
+    '''Brings the index up to date with the files under root. Only files whose mtime differs from the index are read.'''
+    root = path.abspath(root)
+    # LIKE would treat _ and % in the root as wildcards and ignore case, so the prefix is compared exactly
+    prefix = path.join(root, '')
+    known = {}
+    for table in ('scm', 'sca', 'bp'):
+        for filepath, mtime in db.execute(f'SELECT path, mtime FROM {table} WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)):
+            known[filepath] = (table, mtime)
+
+    updated = 0
+    for dirpath, dirnames, filenames in walk(root):
+        for filename in filenames:
+            table, index_file = index_file_type(filename)
+            if not table: continue
+
+            filepath = path.join(dirpath, filename)
+            mtime = path.getmtime(filepath)
+            if known.pop(filepath, (None, None))[1] == mtime: continue
+
+            try: row = index_file(filepath)
+            except Exception as e:  # a malformed file should not stop the rest of the directory from being indexed
+                print('could not index', filepath, e)
+                continue
+            if row is None: continue
+
+            db.execute(f'INSERT OR REPLACE INTO {table} VALUES ({", ".join("?" * (len(row) + 2))})', (filepath, mtime, *row))
+            updated += 1
+
+    # anything left was not found on disk anymore
+    for filepath, (table, mtime) in known.items():
+        db.execute(f'DELETE FROM {table} WHERE path = ?', (filepath,))
+
+    db.commit()
+    return updated, len(known)
+
+
+def animations_for_skeleton(db, scm_path):
+    '''Returns the paths of indexed animations whose bones all exist in the given model's skeleton'''
+    row = db.execute('SELECT bone_names, skeleton FROM scm WHERE path = ?', (path.abspath(scm_path),)).fetchone()
+    if not row: return []
+
+    bone_names, skeleton = row
+    scm_bones = {name.lower() for name in bone_names.split('\n')}
+
+    result = [sca_path for (sca_path,) in db.execute('SELECT path FROM sca WHERE skeleton = ?', (skeleton,))]
+    for sca_path, sca_bone_names in db.execute('SELECT path, bone_names FROM sca WHERE skeleton != ?', (skeleton,)):
+        if {name.lower() for name in sca_bone_names.split('\n')} <= scm_bones: result.append(sca_path)
+    return result
+
+
+def largest_meshes(db, limit=10):
+    return db.execute('SELECT path, vert_count, face_count FROM scm ORDER BY vert_count DESC LIMIT ?', (limit,)).fetchall()
+
+
+def longest_animations(db, limit=10):
+    return db.execute('SELECT path, frame_count, duration FROM sca ORDER BY duration DESC LIMIT ?', (limit,)).fetchall()
+
+
+def blueprints_using(db, name):
+    '''Returns the paths of indexed blueprints which reference the given mesh or texture name'''
+    # names are compared as whole entries of the newline separated lists, as LIKE would treat the _ in most names as a wildcard
+    entry = f'\n{name}\n'
+    query = "SELECT path FROM bp WHERE instr(char(10) || mesh_names || char(10), ?) OR instr(char(10) || texture_names || char(10), ?)"
+    return [bp_path for (bp_path,) in db.execute(query, (entry, entry))]
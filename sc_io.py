@@ -1,6 +1,9 @@
-from os import path
+from array import array
+from shutil import copyfileobj
+from tempfile import TemporaryFile
 import struct
 import math
+from . import sc_vfs
 
 # modl description
 #    tag version bone_offset bone_count vertices_offset vert_unk vertices_count
@@ -17,6 +20,9 @@ import math
 #    tag version frames duration bones names_offset links_offset frames_offset frame_size
 
 
+scm_vert_format = '3f3f3f3f2f2f4B'
+
+
 def pad(size):
     val = 16 - (size % 16)
     return val + 16 if (val < 4) else val
@@ -29,15 +35,42 @@ def pad_file(file, s4comment):
     return file.tell()
 
 
+def read_cstr(file):
+    buffer = b''
+    while True:
+        b = file.read(1)
+        if b == b'\0' or not b: break
+        buffer += b
+    return buffer.decode('ascii')
+
+
+def read_scm_header(filepath):
+    # reads only the modl header and the bone names, skipping vertex and face data
+    if sc_vfs.isfile(filepath): sc = sc_vfs.open_file(filepath)
+    else: return
+
+    modl = struct.unpack('4s11I', sc.read(48))
+    sc.seek(modl[2])
+    name_offsets = [bone[23] for bone in struct.iter_unpack('16f3f4f4i', sc.read(108 * modl[11]))]
+
+    bone_names = []
+    for name_offset in name_offsets:
+        sc.seek(name_offset)
+        bone_names.append(read_cstr(sc))
+
+    sc.close()
+    return modl, bone_names
+
+
 def read_scm(filepath):
-    if path.isfile(filepath): sc = open(filepath, 'rb')
+    if sc_vfs.isfile(filepath): sc = sc_vfs.open_file(filepath)
     else: return
 
     modl = struct.unpack('4s11I', sc.read(48))
     sc.seek(modl[2])
     bones = tuple(struct.iter_unpack('16f3f4f4i', sc.read(108 * modl[11])))
     sc.seek(modl[4])
-    verts = tuple(struct.iter_unpack('3f3f3f3f2f2f4B', sc.read(68 * modl[6])))
+    verts = tuple(struct.iter_unpack(scm_vert_format, sc.read(68 * modl[6])))
     sc.seek(modl[7])
     faces = tuple(struct.unpack('H' * modl[8], sc.read(2 * modl[8])))
     sc.seek(modl[9])
@@ -47,51 +80,72 @@ def read_scm(filepath):
     bone_names = []
     for bone in bones:
         sc.seek(bone[23])
-        buffer = b''
-        while True:
-            b = sc.read(1)
-            if b == b'\0': break
-            buffer += b
-        bone_names.append(buffer.decode('ascii'))
+        bone_names.append(read_cstr(sc))
 
     sc.close()
     return bones, bone_names, verts, faces
 
 
-def write_scm(filepath, modl, bones, bone_names, verts, faces, info):
-    with open(filepath, 'w+b') as f:
+def write_scm(filepath, modl, bones, bone_names, meshes, info):
+    # meshes is an iterable of (packed vertices, index array) pairs which is consumed as it is written,
+    # so the section offsets and counts in the header are only known afterwards and patched in at the end
+    modl = list(modl)
+    with open(filepath, 'w+b') as f, TemporaryFile() as face_spool:
         f.write(struct.pack('4s11I', *modl))
 
         pad_file(f, b'NAME')
         for name in bone_names:
             f.write(struct.pack(f'{str(len(name))}sx', name))
-        pad_file(f, b'SKEL')
+        modl[2] = pad_file(f, b'SKEL')
         f.write(struct.pack('16f3f4f4i' * (len(bones) // 27), *bones))
-        pad_file(f, b'VRTX')
-        f.write(struct.pack('3f3f3f3f2f2f4B' * (len(verts) // 20), *verts))
-        pad_file(f, b'TRIS')
-        f.write(struct.pack('H' * len(faces) , *faces))
+        modl[4] = pad_file(f, b'VRTX')
+
+        vert_count = 0
+        face_count = 0
+        for verts, faces in meshes:
+            f.write(verts)
+            face_spool.write(array('H', (ii + vert_count for ii in faces)))
+            vert_count += len(verts) // 68
+            face_count += len(faces)
+        modl[6] = vert_count
+
+        modl[7] = pad_file(f, b'TRIS')
+        modl[8] = face_count
+        face_spool.seek(0)
+        copyfileobj(face_spool, f)
 
         if len(info):
-            pad_file(f, b'INFO')
-            struct.pack(f'{len(info)}s', info)
+            modl[9] = pad_file(f, b'INFO')
+            modl[10] = len(info)
+            f.write(struct.pack(f'{len(info)}s', info))
+
+        f.seek(0)
+        f.write(struct.pack('4s11I', *modl))
 
 
-def read_sca(filepath):
-    if path.isfile(filepath): sc = open(filepath, 'rb')
+def read_sca_header(filepath):
+    # reads only the anim header and the bone names, skipping frame data
+    if sc_vfs.isfile(filepath): sc = sc_vfs.open_file(filepath)
     else: return
 
     anim = struct.unpack('4sIIfIIIII', sc.read(36))
 
-    link_keys = []
     sc.seek(anim[5])
-    for ii in range(anim[4]):
-        buffer = b''
-        while True:
-            b = sc.read(1)
-            if b == b'\x00': break
-            buffer += b
-        link_keys.append(buffer.decode('ascii'))
+    link_keys = [read_cstr(sc) for ii in range(anim[4])]
+
+    sc.close()
+    return anim, link_keys
+
+
+def read_sca(filepath, frame_start=0, frame_end=-1, frame_step=1):
+    # frame_end is inclusive, with a negative value meaning the last frame of the file
+    if sc_vfs.isfile(filepath): sc = sc_vfs.open_file(filepath)
+    else: return
+
+    anim = struct.unpack('4sIIfIIIII', sc.read(36))
+
+    sc.seek(anim[5])
+    link_keys = [read_cstr(sc) for ii in range(anim[4])]
 
     # * skipping this as we assume that the skeleton will have the same heirarchy as the scm
     # sc.seek(anim[6])
@@ -99,8 +153,12 @@ def read_sca(filepath):
 
     sc.seek(anim[7])
     root = struct.unpack('7f', sc.read(28))
+    # every frame has the same size, so any frame can be reached with a single seek
+    frame_size = anim[8] or 8 + 28 * anim[4]
+    frame_range = range(max(frame_start, 0), anim[2] if frame_end < 0 else min(frame_end + 1, anim[2]), max(frame_step, 1))
     frames = []
-    for ii in range(anim[2]):
+    for ii in frame_range:
+        sc.seek(anim[7] + 28 + ii * frame_size)
         header = struct.unpack('fI', sc.read(8))
         data = list(struct.iter_unpack('7f', sc.read(28 * anim[4])))
         frames.append([*header, {link_keys[ii]:data[ii] for ii in range(anim[4])}])
@@ -110,19 +168,33 @@ def read_sca(filepath):
 
 
 def write_sca(filepath, anim, names, links, frames):
+    # frames is an iterable of flat per-frame values which is consumed as it is written,
+    # so the frame count, duration and section offsets in the header are patched in at the end
+    anim = list(anim)
     with open(filepath, 'w+b') as f:
         f.write(struct.pack('4siifiiiii', *anim))
-        pad_file(f, b'NAME')
+        anim[5] = pad_file(f, b'NAME')
         f.write(struct.pack(str(len(names)) + 's', names.encode('ascii')))
-        pad_file(f, b'LINK')
+        anim[6] = pad_file(f, b'LINK')
         f.write(struct.pack(str(len(links)) + 'i', *links))
-        pad_file(f, b'DATA')
+        anim[7] = pad_file(f, b'DATA')
         f.write(struct.pack('7f', 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0))
-        f.write(struct.pack(f'fi{7 * len(links)}f' * (len(frames) // (7 * len(links) + 2)), *frames))
+
+        frame_struct = struct.Struct(f'fi{7 * len(links)}f')
+        anim[2] = 0
+        anim[8] = frame_struct.size
+        for frame in frames:
+            f.write(frame_struct.pack(*frame))
+            anim[2] += 1
+            anim[3] = frame[0]
+
+        f.seek(0)
+        f.write(struct.pack('4siifiiiii', *anim))
 
 
 def read_bp(filepath):
-    if path.isfile(filepath): bpf = open(filepath, 'rb').read().decode()
+    if sc_vfs.isfile(filepath):
+        with sc_vfs.open_file(filepath) as bpf: bpf = bpf.read().decode()
     else: return
 
     clean_bp = ''
@@ -1,17 +1,35 @@
 import bpy
 from bpy_extras import image_utils
 from os import path
+from . import sc_vfs
+
+
+def load_image(filepath):
+    archive_path, member = sc_vfs.split_path(filepath)
+    if member is None or not sc_vfs.isfile(filepath):
+        return image_utils.load_image(filepath, place_holder=not path.isfile(filepath), check_existing=True)
+
+    for image in bpy.data.images:
+        if image.get('sc_vfs_path') == filepath: return image
+
+    # images inside of archives are packed into the blend file straight from memory
+    data = sc_vfs.read_member(archive_path, member)
+    image = bpy.data.images.new(path.basename(member), 1, 1)
+    image.pack(data=data, data_len=len(data))
+    image.source = 'FILE'
+    image['sc_vfs_path'] = filepath
+    return image
 
 
 def do_unit_nodes(tree, albedo_path=None, specteam_path=None, team_color=(0, 0, 1, 1)):
-    albedo_image_node_im = image_utils.load_image(albedo_path, place_holder=not path.isfile(albedo_path), check_existing=True)
+    albedo_image_node_im = load_image(albedo_path)
     albedo_image_node_im.alpha_mode = 'CHANNEL_PACKED'
     albedo_image_node = tree.nodes.new('ShaderNodeTexImage')
     albedo_image_node.image = albedo_image_node_im
     albedo_image_node.interpolation = 'Closest'
     albedo_image_node.location = (-350.0, -150.0)
 
-    specteam_image_node_im = image_utils.load_image(specteam_path, place_holder=not path.isfile(specteam_path), check_existing=True)
+    specteam_image_node_im = load_image(specteam_path)
     specteam_image_node_im.alpha_mode = 'CHANNEL_PACKED'
     specteam_image_node = tree.nodes.new('ShaderNodeTexImage')
     specteam_image_node.image = specteam_image_node_im
@@ -34,7 +52,7 @@ def do_unit_nodes(tree, albedo_path=None, specteam_path=None, team_color=(0, 0,
 
 
 def do_seraphim_nodes(tree, albedo_path=None, team_color=(1, 1, 0, 1)):
-    albedo_image_node_im = image_utils.load_image(albedo_path, place_holder=not path.isfile(albedo_path), check_existing=True)
+    albedo_image_node_im = load_image(albedo_path)
     albedo_image_node_im.alpha_mode = 'CHANNEL_PACKED'
     albedo_image_node = tree.nodes.new('ShaderNodeTexImage')
     albedo_image_node.image = albedo_image_node_im
@@ -0,0 +1,106 @@
+from array import array
+from collections import deque
+
+# vertex cache optimization after Tom Forsyth's "Linear-Speed Vertex Cache Optimisation"
+# faces are flat sequences of triangle vertex indices, as they are stored in the scm
+
+cache_size = 32
+cache_decay_power = 1.5
+last_tri_score = 0.75
+valence_boost_scale = 2.0
+valence_boost_power = 0.5
+
+
+def acmr(faces, size=cache_size):
+    '''Average cache miss ratio, the number of vertex transforms per triangle with a fifo cache of the given size'''
+    cache = deque()
+    cached = set()
+    misses = 0
+    for v in faces:
+        if v in cached: continue
+        misses += 1
+        cache.append(v)
+        cached.add(v)
+        if len(cache) > size: cached.discard(cache.popleft())
+    return misses / max(len(faces) // 3, 1)
+
+
+def vertex_score(cache_pos, remaining):
+    if remaining == 0: return -1.0
+
+    score = 0.0
+    if cache_pos >= 0:
+        # the last triangle's vertices get a fixed score so that the next triangle does not simply reuse its edge
+        if cache_pos < 3: score = last_tri_score
+        else: score = (1.0 - (cache_pos - 3) / (cache_size - 3)) ** cache_decay_power
+
+    # vertices with few remaining triangles are boosted so that they get finished off and leave the cache
+    return score + valence_boost_scale * remaining ** -valence_boost_power
+
+
+def optimize_faces(faces, vert_count):
+    '''Returns the triangles of faces reordered for post-transform vertex cache reuse'''
+    tri_count = len(faces) // 3
+    if tri_count == 0: return array('I', faces)
+
+    vert_tris = [[] for ii in range(vert_count)]
+    for tri in range(tri_count):
+        for v in faces[tri * 3:tri * 3 + 3]: vert_tris[v].append(tri)
+
+    cache_pos = [-1] * vert_count
+    vert_scores = [vertex_score(-1, len(tris)) for tris in vert_tris]
+    tri_scores = [sum(vert_scores[v] for v in faces[tri * 3:tri * 3 + 3]) for tri in range(tri_count)]
+    tri_added = [False] * tri_count
+
+    cache = []
+    result = array('I')
+    scan = 0
+    best = max(range(tri_count), key=tri_scores.__getitem__)
+
+    while best >= 0:
+        tri_added[best] = True
+        tri_verts = tuple(faces[best * 3:best * 3 + 3])
+        result.extend(tri_verts)
+
+        for v in tri_verts: vert_tris[v].remove(best)
+
+        # the added triangle's vertices move to the front of the lru cache, pushing the rest back
+        cache = [*tri_verts, *(v for v in cache if v not in tri_verts)]
+        for ii, v in enumerate(cache): cache_pos[v] = ii if ii < cache_size else -1
+
+        touched = set()
+        for v in cache:
+            vert_scores[v] = vertex_score(cache_pos[v], len(vert_tris[v]))
+            touched.update(vert_tris[v])
+        cache = cache[:cache_size]
+
+        best = -1
+        best_score = -1.0
+        for tri in touched:
+            score = tri_scores[tri] = sum(vert_scores[v] for v in faces[tri * 3:tri * 3 + 3])
+            if score > best_score: best, best_score = tri, score
+
+        if best < 0:
+            # nothing left that touches the cache, so continue with the next triangle that has not been added
+            while scan < tri_count and tri_added[scan]: scan += 1
+            best = scan if scan < tri_count else -1
+
+    return result
+
+
+def reorder_verts(faces, vert_count):
+    '''Returns the vertex order by first use in faces, and faces remapped to that order.
+    Vertices which no face uses keep their relative order at the end.'''
+    remap = [-1] * vert_count
+    order = []
+    for v in faces:
+        if remap[v] < 0:
+            remap[v] = len(order)
+            order.append(v)
+
+    for v in range(vert_count):
+        if remap[v] < 0:
+            remap[v] = len(order)
+            order.append(v)
+
+    return order, array('I', (remap[v] for v in faces))
@@ -0,0 +1,135 @@
+import os
+import zipfile
+from collections import OrderedDict, namedtuple
+from fnmatch import fnmatch
+from io import BytesIO
+from os import path
+
+# paths may point inside of an archive, for example 'gamedata/units.scd/units/uel0001/uel0001_lod0.scm'
+# any path component ending in one of archive_exts which is a real file is treated as an archive
+
+archive_exts = ('.scd', '.zip')
+member_cache_budget = 256 * 2**20
+
+vfs_stat = namedtuple('vfs_stat', ('st_mtime_ns', 'st_size'))
+
+# maps a normalized archive path to its mtime, zip file while open, and lowercase member name to zip info lookup
+archives = {}
+# maps (normalized archive path, archive mtime, member name) to decompressed member bytes, least recently used first
+member_cache = OrderedDict()
+member_cache_size = 0
+
+
+def split_path(filepath):
+    '''Returns the archive path and member name of a virtual path, or the path and None for anything else'''
+    if path.exists(filepath): return filepath, None
+
+    parts = filepath.replace('\\', '/').split('/')
+    for ii in range(len(parts) - 1):
+        archive_path = '/'.join(parts[:ii + 1])
+        if archive_path.lower().endswith(archive_exts) and path.isfile(archive_path):
+            return archive_path, '/'.join(part for part in parts[ii + 1:] if part).lower()
+
+    return filepath, None
+
+
+def archive_key(archive_path):
+    # the same archive may be given with native or forward separators, or relative, and must only be indexed once
+    return path.normcase(path.abspath(archive_path))
+
+
+def archive(archive_path):
+    key = archive_key(archive_path)
+    mtime = os.stat(key).st_mtime_ns
+    cached = archives.get(key)
+    if cached and cached[0] == mtime: return cached
+
+    if cached:
+        if cached[1]: cached[1].close()
+        # members of the old archive can not be read again, so their bytes only take up budget
+        for member_key in [member_key for member_key in member_cache if member_key[0] == key]: purge_member(member_key)
+    zf = zipfile.ZipFile(key)
+    # the central directory is only read once, lookups are case insensitive like the game's
+    members = {info.filename.replace('\\', '/').lower(): info for info in zf.infolist() if not info.is_dir()}
+    archives[key] = [mtime, zf, members]
+    return archives[key]
+
+
+def close_archives():
+    '''Closes the file handles of every open archive, so that other programs can replace them.
+    The member lookups are kept, an archive is only reopened to read a member which is not cached.'''
+    for cached in archives.values():
+        if cached[1]: cached[1].close()
+        cached[1] = None
+
+
+def purge_member(member_key):
+    global member_cache_size
+    member_cache_size -= len(member_cache.pop(member_key))
+
+
+def read_member(archive_path, member):
+    global member_cache_size
+
+    # the mtime is part of the key so that a rewritten archive is not served from the cache
+    key = archive_key(archive_path)
+    cached = archive(key)
+    member_key = (key, cached[0], member)
+    data = member_cache.get(member_key)
+    if data is not None:
+        member_cache.move_to_end(member_key)
+        return data
+
+    if cached[1] is None: cached[1] = zipfile.ZipFile(key)
+    data = cached[1].read(cached[2][member])
+
+    member_cache[member_key] = data
+    member_cache_size += len(data)
+    while member_cache_size > member_cache_budget and len(member_cache) > 1:
+        member_cache_size -= len(member_cache.popitem(last=False)[1])
+
+    return data
+
+
+def is_archive(filepath):
+    return filepath.lower().endswith(archive_exts) and path.isfile(filepath)
+
+
+def isfile(filepath):
+    archive_path, member = split_path(filepath)
+    if member is None: return path.isfile(filepath)
+    return member in archive(archive_path)[2]
+
+
+def open_file(filepath):
+    archive_path, member = split_path(filepath)
+    if member is None: return open(filepath, 'rb')
+    return BytesIO(read_member(archive_path, member))
+
+
+def stat(filepath):
+    archive_path, member = split_path(filepath)
+    if member is None:
+        st = os.stat(filepath)
+        return vfs_stat(st.st_mtime_ns, st.st_size)
+    mtime, zf, members = archive(archive_path)
+    return vfs_stat(mtime, members[member].file_size)
+
+
+def listdir(dirpath):
+    archive_path, member = split_path(dirpath)
+    if member is None:
+        if is_archive(dirpath): archive_path, member = dirpath, ''
+        else: return os.listdir(dirpath)
+
+    prefix = member + '/' if member else ''
+    names = set()
+    for name in archive(archive_path)[2]:
+        if name.startswith(prefix): names.add(name[len(prefix):].split('/')[0])
+    return sorted(names)
+
+
+def glob(archive_path, pattern):
+    '''Returns the virtual paths of every member of the archive matching the pattern'''
+    pattern = pattern.replace('\\', '/').lower()
+    return [f'{archive_path}/{name}' for name in archive(archive_path)[2] if fnmatch(name, pattern)]